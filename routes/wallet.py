@@ -1,12 +1,21 @@
-import json
-import os
+import hashlib
 import uuid
+from functools import lru_cache
+from pathlib import Path
 from typing import Optional
 
 import boto3
+import orjson
 import requests
 from airpress import PKPass
+from airpress.compressor import WWDR_CA
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.serialization import pkcs7
 from fastapi import APIRouter, Cookie, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from models.info import InfoModel
 from models.user import PublicContact
@@ -22,17 +31,166 @@ router = APIRouter(
 
 
 """
-Used to get Discord image.
+Shared DynamoDB table handle, built on first use.
+"""
+
+
+@lru_cache(maxsize=1)
+def _table():
+    # boto3 resources are not thread-safe: only call this from the event loop,
+    # never from inside run_in_threadpool.
+    dynamodb = boto3.resource("dynamodb")
+    return dynamodb.Table(options.get("aws").get("dynamodb").get("table"))
+
+
+# Member attributes read by apple_wallet.
+_PASS_ATTRIBUTES = (
+    "id",
+    "first_name",
+    "surname",
+    "infra_email",
+    "ops_email",
+    "discord",
+)
+
+
+# Static pass assets and signing credentials never change at runtime, so they
+# are read once here instead of on every pass generation.
+_WALLET_STATIC = Path(__file__).resolve().parent.parent / "static" / "apple_wallet"
+_PKI_DIR = Path(__file__).resolve().parent.parent / "config" / "pki"
+
+_ASSETS = {
+    name: (_WALLET_STATIC / name).read_bytes()
+    for name in (
+        "icon.png",
+        "icon@2x.png",
+        "logo_ops.png",
+        "logo_ops@2x.png",
+        "logo_reg.png",
+        "logo_reg@2x.png",
+        "PFP.png",
+    )
+}
+_PKI_KEY = (_PKI_DIR / "hackucf.key").read_bytes()
+_PKI_CERT = (_PKI_DIR / "hackucf.pem").read_bytes()
+
+# airpress re-parses the PEM key and certs on every .sign(), so parse them once.
+_SIGNING_KEY = serialization.load_pem_private_key(_PKI_KEY, None)
+_SIGNING_CERT = x509.load_pem_x509_certificate(_PKI_CERT)
+_WWDR_CERT = x509.load_der_x509_certificate(WWDR_CA)
+
+
+class _PKPass(PKPass):
+    """
+    PKPass that signs the manifest with the preloaded credentials.
+    """
+
+    def sign(self) -> bytes:
+        self._signature = (
+            pkcs7.PKCS7SignatureBuilder()
+            .set_data(self.manifest)
+            .add_signer(_SIGNING_CERT, _SIGNING_KEY, hashes.SHA256())
+            .add_certificate(_WWDR_CERT)
+            .sign(
+                serialization.Encoding.DER,
+                [pkcs7.PKCS7Options.DetachedSignature, pkcs7.PKCS7Options.Binary],
+            )
+        )
+        return self._signature
+
+
+# Shared connection pool for profile picture fetches, so repeat requests to the
+# Discord CDN reuse an existing TLS session instead of handshaking every time.
+# One retry at most and none after a read timeout, so a hung CDN costs a pass
+# roughly one connect plus one read timeout rather than several.
+_IMG_SESSION = requests.Session()
+_IMG_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=64,
+        max_retries=Retry(
+            total=1, read=0, backoff_factor=0.3, status_forcelist=(502, 503, 504)
+        ),
+    ),
+)
+
+
+# Only successful downloads are cached; lru_cache does not memoise raises.
+# Avatars are requested at ?size=512, i.e. a few hundred KB each, so 64 entries
+# keeps this to roughly 20 MB per worker.
+@lru_cache(maxsize=64)
+def _fetch_img(url):
+    resp = _IMG_SESSION.get(url, timeout=(2.0, 5.0))
+    # No such avatar (e.g. default avatars, stored as .../None.png), so cache
+    # the fallback rather than asking the CDN again on every download.
+    if resp.status_code == 404:
+        return _ASSETS["PFP.png"]
+    resp.raise_for_status()
+    return resp.content
+
+
+"""
+Used to get Discord image, falling back to the bundled Hack@UCF PFP.
 """
 
 
 def get_img(url):
-    resp = requests.get(url, stream=True)
-    status = resp.status_code
-    if status < 400:
-        return resp.raw.read()
-    else:
-        return get_img("https://cdn.hackucf.org/PFP.png")
+    try:
+        return _fetch_img(url)
+    except requests.RequestException:
+        return _ASSETS["PFP.png"]
+
+
+# Parts of pass.json shared by every member; apple_wallet fills in the rest.
+# Treat as read-only, since nested values are shared between passes.
+_PASS_TEMPLATE = {
+    "passTypeIdentifier": "pass.org.hackucf.join",
+    "formatVersion": 1,
+    "teamIdentifier": "VWTW9R97Q4",
+    "organizationName": "Hack@UCF",
+    "description": "Hack@UCF Membership ID",
+    "locations": [
+        {
+            "latitude": 28.601366109876327,
+            "longitude": -81.19867691612126,
+            "relevantText": "You're near the CyberLab!",
+        }
+    ],
+    "foregroundColor": "#D2990B",
+    "backgroundColor": "#1C1C1C",
+    "labelColor": "#ffffff",
+    "logoText": "",
+    "generic": {
+        "backFields": [
+            {
+                "label": "View Profile",
+                "key": "view-profile",
+                "value": "You can view and edit your profile at https://join.hackucf.org/profile.",
+                "attributedValue": "You can view and edit your profile at <a href='https://join.hackucf.org/profile'>join.hackucf.org</a>.",
+            },
+            {
+                "label": "Check In",
+                "key": "check-in",
+                "value": "At a meeting? Visit https://hackucf.org/signin to sign in",
+                "attributedValue": "At a meeting? Visit <a href='https://hackucf.org/signin'>hackucf.org/signin</a> to sign in.",
+            },
+        ],
+    },
+}
+
+
+# Changes whenever a deploy changes the assets, template or signing cert, so
+# pass ETags from an older deploy stop matching.
+_PASS_VERSION = hashlib.sha256(
+    b"".join(
+        [
+            *(hashlib.sha256(_ASSETS[name]).digest() for name in sorted(_ASSETS)),
+            hashlib.sha256(orjson.dumps(_PASS_TEMPLATE)).digest(),
+            hashlib.sha256(_PKI_CERT).digest(),
+        ]
+    )
+).hexdigest()
 
 
 """
@@ -42,47 +200,18 @@ User data -> Apple Wallet blob
 
 def apple_wallet(user_data):
     # Create empty pass package
-    p = PKPass()
+    p = _PKPass()
 
     is_ops = True if user_data.get("ops_email", False) else False
 
     # Add locally stored assets
-    with open(
-        os.path.join(
-            os.path.dirname(__file__), "..", "static", "apple_wallet", "icon.png"
-        ),
-        "rb",
-    ) as file:
-        ico_data = file.read()
-        p.add_to_pass_package(("icon.png", ico_data))
-
-    with open(
-        os.path.join(
-            os.path.dirname(__file__), "..", "static", "apple_wallet", "icon@2x.png"
-        ),
-        "rb",
-    ) as file:
-        ico_data = file.read()
-        p.add_to_pass_package(("icon@2x.png", ico_data))
+    p.add_to_pass_package(("icon.png", _ASSETS["icon.png"]))
+    p.add_to_pass_package(("icon@2x.png", _ASSETS["icon@2x.png"]))
 
+    # Only the member-specific fields are built per pass.
     pass_json = {
-        "passTypeIdentifier": "pass.org.hackucf.join",
-        "formatVersion": 1,
-        "teamIdentifier": "VWTW9R97Q4",
-        "organizationName": "Hack@UCF",
+        **_PASS_TEMPLATE,
         "serialNumber": str(uuid.uuid4()),
-        "description": "Hack@UCF Membership ID",
-        "locations": [
-            {
-                "latitude": 28.601366109876327,
-                "longitude": -81.19867691612126,
-                "relevantText": "You're near the CyberLab!",
-            }
-        ],
-        "foregroundColor": "#D2990B",
-        "backgroundColor": "#1C1C1C",
-        "labelColor": "#ffffff",
-        "logoText": "",
         "barcodes": [
             {
                 "format": "PKBarcodeFormatQR",
@@ -92,6 +221,7 @@ def apple_wallet(user_data):
             }
         ],
         "generic": {
+            **_PASS_TEMPLATE["generic"],
             "primaryFields": [
                 {
                     "label": "Name",
@@ -108,110 +238,59 @@ def apple_wallet(user_data):
                     "value": user_data.get("infra_email", "Not Provisioned"),
                 }
             ],
-            "backFields": [
-                {
-                    "label": "View Profile",
-                    "key": "view-profile",
-                    "value": "You can view and edit your profile at https://join.hackucf.org/profile.",
-                    "attributedValue": "You can view and edit your profile at <a href='https://join.hackucf.org/profile'>join.hackucf.org</a>.",
-                },
-                {
-                    "label": "Check In",
-                    "key": "check-in",
-                    "value": "At a meeting? Visit https://hackucf.org/signin to sign in",
-                    "attributedValue": "At a meeting? Visit <a href='https://hackucf.org/signin'>hackucf.org/signin</a> to sign in.",
-                },
-            ],
         },
     }
 
-    # I am duplicating the file reads because it's easier than re-setting file pointers to the start of each file.
-    # I think.
-
     # User profile image
     discord_img = user_data.get("discord", {}).get("avatar", False)
     if discord_img:
         img_data = get_img(discord_img)
         p.add_to_pass_package(("thumbnail.png", img_data))
-
-        img_data = get_img(discord_img)
         p.add_to_pass_package(("thumbnail@2x.png", img_data))
 
     # Role-based logo.
     if is_ops:
-        with open(
-            os.path.join(
-                os.path.dirname(__file__),
-                "..",
-                "static",
-                "apple_wallet",
-                "logo_ops@2x.png",
-            ),
-            "rb",
-        ) as file:
-            ico_data = file.read()
-            p.add_to_pass_package(("logo@2x.png", ico_data))
-
-        with open(
-            os.path.join(
-                os.path.dirname(__file__),
-                "..",
-                "static",
-                "apple_wallet",
-                "logo_ops.png",
-            ),
-            "rb",
-        ) as file:
-            ico_data = file.read()
-            p.add_to_pass_package(("logo.png", ico_data))
+        p.add_to_pass_package(("logo@2x.png", _ASSETS["logo_ops@2x.png"]))
+        p.add_to_pass_package(("logo.png", _ASSETS["logo_ops.png"]))
     else:
-        with open(
-            os.path.join(
-                os.path.dirname(__file__),
-                "..",
-                "static",
-                "apple_wallet",
-                "logo_reg@2x.png",
-            ),
-            "rb",
-        ) as file:
-            ico_data = file.read()
-            p.add_to_pass_package(("logo@2x.png", ico_data))
-
-        with open(
-            os.path.join(
-                os.path.dirname(__file__),
-                "..",
-                "static",
-                "apple_wallet",
-                "logo_reg.png",
-            ),
-            "rb",
-        ) as file:
-            ico_data = file.read()
-            p.add_to_pass_package(("logo.png", ico_data))
-
-    pass_data = json.dumps(pass_json).encode("utf8")
+        p.add_to_pass_package(("logo@2x.png", _ASSETS["logo_reg@2x.png"]))
+        p.add_to_pass_package(("logo.png", _ASSETS["logo_reg.png"]))
+
+    pass_data = orjson.dumps(pass_json)
 
     p.add_to_pass_package(("pass.json", pass_data))
 
-    # Add locally stored credentials
-    with open(
-        os.path.join(os.path.dirname(__file__), "..", "config/pki/hackucf.key"), "rb"
-    ) as key, open(
-        os.path.join(os.path.dirname(__file__), "..", "config/pki/hackucf.pem"), "rb"
-    ) as cert:
-        # Add credentials to pass package
-        p.key = key.read()
-        p.cert = cert.read()
-
-    # As we've added credentials to pass package earlier we don't need to supply them to `.sign()`
-    # This is an alternative to calling .sign() method with credentials as arguments.
+    # Sign with the credentials parsed at import.
     p.sign()
 
     return p
 
 
+"""
+User data -> ETag for the generated pass
+"""
+
+
+def pass_etag(user_data):
+    # Each download gets a fresh serial and signature, so the tag is weak: it
+    # only changes when the deploy or a member field shown on the pass changes.
+    discord = user_data.get("discord", {})
+    fingerprint = "|".join(
+        str(value)
+        for value in (
+            _PASS_VERSION,
+            user_data.get("id", ""),
+            user_data.get("first_name", ""),
+            user_data.get("surname", ""),
+            user_data.get("infra_email", ""),
+            bool(user_data.get("ops_email", False)),
+            discord.get("username", ""),
+            discord.get("avatar", ""),
+        )
+    )
+    return f'W/"{hashlib.sha256(fingerprint.encode("utf8")).hexdigest()}"'
+
+
 """
 Get API information.
 """
@@ -239,16 +318,33 @@ async def aapl_gen(
     token: Optional[str] = Cookie(None),
     payload: Optional[object] = {},
 ):
-    dynamodb = boto3.resource("dynamodb")
-    table = dynamodb.Table(options.get("aws").get("dynamodb").get("table"))
-
-    # Get data from DynamoDB
-    user_data = table.get_item(Key={"id": payload.get("id")}).get("Item", None)
+    table = _table()
+
+    # Get data from DynamoDB, only pulling the attributes the pass uses.
+    user_data = table.get_item(
+        Key={"id": payload.get("id")},
+        ProjectionExpression=", ".join(f"#{attr}" for attr in _PASS_ATTRIBUTES),
+        ExpressionAttributeNames={f"#{attr}": attr for attr in _PASS_ATTRIBUTES},
+    ).get("Item", None)
+
+    # Skip signing entirely if the client already has this pass.
+    etag = pass_etag(user_data)
+    cache_headers = {"ETag": etag, "Cache-Control": "private, max-age=3600"}
+    client_tags = {
+        tag.strip().removeprefix("W/")
+        for tag in request.headers.get("if-none-match", "").split(",")
+    }
+    if "*" in client_tags or etag.removeprefix("W/") in client_tags:
+        return Response(status_code=304, headers=cache_headers)
 
-    p = apple_wallet(user_data)
+    # Avatar download and signing block, so keep them off the event loop.
+    p = await run_in_threadpool(apple_wallet, user_data)
 
     return Response(
         content=bytes(p),
         media_type="application/vnd.apple.pkpass",
-        headers={"Content-Disposition": 'attachment; filename="hackucf.pkpass"'},
+        headers={
+            "Content-Disposition": 'attachment; filename="hackucf.pkpass"',
+            **cache_headers,
+        },
     )
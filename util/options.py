@@ -1,20 +1,30 @@
-import json
 import os
+from functools import lru_cache
 
+import orjson
 import yaml
 
+# Prefer libyaml's C parser when PyYAML was built with it.
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
 
 class Options:
     def __init__(self):
         super(Options, self).__init__
 
+    # Every module calls this at import; parse the file once and share it.
+    # Callers must treat the returned dict as read-only.
+    @lru_cache(maxsize=None)
     def fetch(path="config/options.yml"):
         # Get file path
         full_path = os.path.join(os.getcwd(), path)
 
         # Load options.
         with open(full_path, "r") as file:
-            options = yaml.safe_load(file)
+            options = yaml.load(file, Loader=_Loader)
 
         return options
 
@@ -26,6 +36,7 @@ class Options:
     def get_form_body(file="1"):
         try:
             form_file = os.path.join(os.getcwd(), "forms", f"{file}.json")
-            return json.load(open(form_file, "r"))
+            with open(form_file, "rb") as f:
+                return orjson.loads(f.read())
         except FileNotFoundError:
             return {}